@@ -2,21 +2,71 @@
 # The MIT License (MIT)
 # Copyright (c) 2025 Jonathan Chiu
 
+import os
+import re
+import atexit
+import asyncio
+import locale
 import sys
 import json
+import queue
+import hashlib
+import heapq
 import shutil
 import subprocess
+import threading
+import time
+import uuid
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import zipfile
 
+try:
+    import win32service
+except ImportError:
+    win32service = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+# ISA-L is a drop-in for zlib with faster SIMD CRC32 and DEFLATE kernels.
+# It only knows levels 0-3 and no default (-1), so always pass a level.
+if isal_zlib is not None:
+    zipfile.crc32 = isal_zlib.crc32
+    zipfile.zlib = isal_zlib
+
 # ---------------------------------------------
 # Globals
 # ---------------------------------------------
 CONFIG_FILE = 'config.json'
+CONFIG_BYTES = None
 LOG_FILE_HANDLE = None
 CURRENT_LOG_PATH = None
+BACKUP_FAILED = False  # set when an archive could not be built; main exits 1
 LOG_QUEUE = []
+LOG_LOCK = threading.Lock()
+LOG_LEVELS = {'INFO': 0, 'DONE': 1, 'WARN': 2, 'ERRO': 3}
+LOG_MIN_LEVEL = 0  # raised by the log_level config key
+ZIP_BUFFER_SIZE = 1 << 20  # 1 MiB
+IO_CHUNK = 4 << 20  # 4 MiB
+COMPRESSION = {'stored': zipfile.ZIP_STORED, 'deflated': zipfile.ZIP_DEFLATED}
+DEFLATE_LEVEL = 1  # fastest; most of the size win at a fraction of the CPU
+ARCHIVE_EXT = {'zip': '.zip', '7z': '.zip', 'zst': '.tar.zst'}
+VERSION_RE = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2})([0-9]{2})([0-9]{2})')  # '%Y-%m-%d %H%M%S'
+SERVICE_STOPPED = 1  # SCM CurrentState values
+SERVICE_RUNNING = 4
+ERROR_SERVICE_ALREADY_RUNNING = 1056
+ERROR_SERVICE_NOT_ACTIVE = 1062
+ERROR_SERVICE_SPECIFIC_ERROR = 1066
+SERVICE_TIMEOUT = 120  # seconds
 USAGE = '''Usage:
     python main.py [command]
 
@@ -33,43 +83,57 @@ Commands:
     stop             Stop services and docker containers
     stopDocker       Stop docker containers only
     stopServices     Stop services only'''
-COMMANDS = ['backup', 'help', 'prune', 'start', 'startDocker', 'startServices', 'stop', 'stopDocker', 'stopServices', 'restart', 'restartDocker', 'restartServices']
 
 # ---------------------------------------------
 # Utility: timestamp
 # ---------------------------------------------
 def now():
-    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return time.strftime('%Y-%m-%d %H:%M:%S')
 
 def timestamp_folder():
-    return datetime.now().strftime('%Y-%m-%d %H%M%S')
+    return time.strftime('%Y-%m-%d %H%M%S')
 
 # ---------------------------------------------
 # Logging
 # ---------------------------------------------
 def log(msg):
-    print(msg)
-
     global LOG_FILE_HANDLE, LOG_QUEUE
 
-    if LOG_FILE_HANDLE:
-        if len(LOG_QUEUE) > 0:
-            for line in LOG_QUEUE:
-                LOG_FILE_HANDLE.write(line + '\n')
-            LOG_QUEUE.clear()
-        LOG_FILE_HANDLE.write(msg + '\n')
-        LOG_FILE_HANDLE.flush()
-    else:
-        LOG_QUEUE.append(msg)
+    # callable from worker threads; keeps console and file lines whole and in the same order
+    with LOG_LOCK:
+        print(msg)
+
+        if LOG_FILE_HANDLE:
+            if len(LOG_QUEUE) > 0:
+                LOG_FILE_HANDLE.writelines(line + '\n' for line in LOG_QUEUE)
+                LOG_QUEUE.clear()
+            LOG_FILE_HANDLE.write(msg + '\n')
+        else:
+            LOG_QUEUE.append(msg)
 
 def f_log(level, comp, msg):
+    # filtered lines skip the timestamp and formatting entirely
+    if LOG_LEVELS[level] < LOG_MIN_LEVEL:
+        return
+
     line = f'{now()} [{level}] {comp:<7} {msg}'
     log(line)
 
+    # errors usually precede sys.exit, get them on disk right away
+    if level == 'ERRO':
+        flush_log()
+
+def flush_log():
+    with LOG_LOCK:
+        if LOG_FILE_HANDLE:
+            LOG_FILE_HANDLE.flush()
+
 # ---------------------------------------------
 # Load config
 # ---------------------------------------------
-def load_config():
+def load_config(actions):
+    global CONFIG_BYTES, LOG_MIN_LEVEL
+
     f_log('INFO', 'CONFIG', f'Loading config...')
     cfg_path = Path(CONFIG_FILE)
     if not cfg_path.exists():
@@ -77,97 +141,282 @@ def load_config():
         sys.exit(1)
 
     try:
-        cfg = json.loads(cfg_path.read_text(encoding='utf-8'))
+        CONFIG_BYTES = cfg_path.read_bytes()  # kept for the backup snapshot
+        cfg = json_loads(CONFIG_BYTES.removeprefix(b'\xef\xbb\xbf'))  # tolerate a UTF-8 BOM
         f_log('INFO', 'CONFIG', f'Loaded {cfg}')
-        return cfg
     except Exception as e:
         f_log('ERRO', 'CONFIG', f'Failed to parse config: {e}')
         sys.exit(1)
 
+    try:
+        prepare_config(cfg, actions)
+    except (KeyError, TypeError) as e:
+        f_log('ERRO', 'CONFIG', f'Invalid config: missing or malformed {e}')
+        sys.exit(1)
+
+    level = cfg.get('log_level', 'INFO')
+    if level in LOG_LEVELS:
+        LOG_MIN_LEVEL = LOG_LEVELS[level]
+    else:
+        f_log('WARN', 'CONFIG', f'Unknown log level "{level}", using "INFO"')
+
+    return cfg
+
+def prepare_config(cfg, actions):
+    # Derive once what the service/docker operations need on every call;
+    # only for the steps this command runs, so e.g. prune needs neither
+    if actions & {stop_services, start_services}:
+        cfg['_service_names'] = [svc['name'] for svc in cfg['services']]
+
+    if actions & {stop_docker, start_docker}:
+        docker_root = Path(cfg['docker_root'])
+        cfg['_compose_projects'] = []
+        for name in cfg['docker_compose_names']:
+            compose = docker_root / name / 'docker-compose.yml'
+            argv = ['docker', 'compose', '-f', str(compose)]
+            cfg['_compose_projects'].append((name, compose, compose.exists(), argv))
+
 # ---------------------------------------------
-# Run shell command
+# Run command
 # ---------------------------------------------
-def run_cmd(cmd, timeout=None):
+def run_cmd(argv, timeout=None, cwd=None):
+    # argv list, no cmd.exe in between; no console window on Windows
     try:
-        p = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=timeout)
+        p = subprocess.run(argv, capture_output=True, text=True, timeout=timeout, cwd=cwd,
+                           creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
         return p.returncode == 0, (p.stdout or '').strip(), (p.stderr or '').strip(), p.returncode
     except Exception as e:
         return False, '', str(e), -1
 
+async def arun_cmd(argv, timeout=None):
+    # asyncio twin of run_cmd, same return shape
+    try:
+        p = await asyncio.create_subprocess_exec(
+            *argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+        try:
+            out, err = await asyncio.wait_for(p.communicate(), timeout)
+        except asyncio.TimeoutError:
+            p.kill()
+            await p.wait()
+            return False, '', f'Timed out after {timeout}s', -1
+
+        enc = locale.getpreferredencoding(False)  # what text=True would use
+        out = out.decode(enc, errors='replace').replace('\r\n', '\n')
+        err = err.decode(enc, errors='replace').replace('\r\n', '\n')
+        return p.returncode == 0, out.strip(), err.strip(), p.returncode
+    except Exception as e:
+        return False, '', str(e), -1
+
+def run_cmds(argvs, timeout=None):
+    # Commands block on the SCM / docker, so run them all at once from a
+    # single event loop rather than a thread per command.
+    # Results come back in input order; callers log from this thread.
+    if not argvs:
+        return []
+
+    async def run_all():
+        return await asyncio.gather(*(arun_cmd(argv, timeout) for argv in argvs))
+
+    return asyncio.run(run_all())
+
 # ---------------------------------------------
 # Service operations
 # ---------------------------------------------
+def net_stop(names):
+    results = []
+    for ok, out, err, code in run_cmds([['net', 'stop', name] for name in names]):
+        if ok:
+            results.append(('done', ''))
+        elif '3521' in out + err:
+            results.append(('idle', ''))
+        else:
+            results.append(('fail', err or out or f'Return code {code}'))
+    return results
+
+def net_start(names):
+    results = []
+    for ok, out, err, code in run_cmds([['net', 'start', name] for name in names]):
+        if ok:
+            results.append(('done', ''))
+        elif '2182' in out + err:
+            results.append(('idle', ''))
+        else:
+            results.append(('fail', err or out or f'Return code {code}'))
+    return results
+
+def scm_wait(pending, state, timeout, results):
+    # Poll all open service handles until each reaches state; closes them
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        time.sleep(0.1)
+        for name in list(pending):
+            try:
+                status = win32service.QueryServiceStatusEx(pending[name])
+                if status['CurrentState'] == state:
+                    results[name] = ('done', '')
+                elif state == SERVICE_RUNNING and status['CurrentState'] == SERVICE_STOPPED:
+                    # fell back to stopped while starting: it failed, don't wait out the timeout
+                    code = status['Win32ExitCode']
+                    if code == ERROR_SERVICE_SPECIFIC_ERROR:
+                        code = status['ServiceSpecificExitCode']
+                    results[name] = ('fail', f'Stopped while starting, exit code {code}')
+                else:
+                    continue
+            except win32service.error as e:
+                results[name] = ('fail', e.strerror)
+            win32service.CloseServiceHandle(pending.pop(name))
+
+    for name, svc in pending.items():
+        results[name] = ('fail', f'Timed out after {timeout}s')
+        win32service.CloseServiceHandle(svc)
+
+def scm_stop(names, timeout):
+    # Send every stop request first, then wait for all of them in a single
+    # 100 ms polling loop instead of one blocking net.exe per service
+    try:
+        scm = win32service.OpenSCManager(None, None, win32service.SC_MANAGER_CONNECT)
+    except win32service.error:
+        return net_stop(names)
+
+    results = {}
+    pending = {}
+    try:
+        for name in names:
+            try:
+                svc = win32service.OpenService(scm, name, win32service.SERVICE_STOP | win32service.SERVICE_QUERY_STATUS)
+            except win32service.error as e:
+                results[name] = ('fail', e.strerror)
+                continue
+
+            try:
+                win32service.ControlService(svc, win32service.SERVICE_CONTROL_STOP)
+                pending[name] = svc
+                continue
+            except win32service.error as e:
+                results[name] = ('idle', '') if e.winerror == ERROR_SERVICE_NOT_ACTIVE else ('fail', e.strerror)
+            win32service.CloseServiceHandle(svc)
+
+        scm_wait(pending, SERVICE_STOPPED, timeout, results)
+    finally:
+        win32service.CloseServiceHandle(scm)
+
+    return [results[name] for name in names]
+
+def scm_start(names, timeout):
+    # Same batching as scm_stop: issue every start, then wait for all
+    try:
+        scm = win32service.OpenSCManager(None, None, win32service.SC_MANAGER_CONNECT)
+    except win32service.error:
+        return net_start(names)
+
+    results = {}
+    pending = {}
+    try:
+        for name in names:
+            try:
+                svc = win32service.OpenService(scm, name, win32service.SERVICE_START | win32service.SERVICE_QUERY_STATUS)
+            except win32service.error as e:
+                results[name] = ('fail', e.strerror)
+                continue
+
+            try:
+                win32service.StartService(svc, None)
+                pending[name] = svc
+                continue
+            except win32service.error as e:
+                results[name] = ('idle', '') if e.winerror == ERROR_SERVICE_ALREADY_RUNNING else ('fail', e.strerror)
+            win32service.CloseServiceHandle(svc)
+
+        scm_wait(pending, SERVICE_RUNNING, timeout, results)
+    finally:
+        win32service.CloseServiceHandle(scm)
+
+    return [results[name] for name in names]
+
 def stop_services(cfg):
-    for svc in cfg['services']:
-        name = svc['name']
+    # services that are already stopped come back as 'idle'
+    names = cfg['_service_names']
+    for name in names:
         f_log('INFO', 'SERVICE', f'Stopping "{name}"...')
 
-        ok, out, err, code = run_cmd(f'net stop "{name}"')
-        if ok:
-            f_log('DONE', 'SERVICE', f'Stopped "{name}"')
-            continue
+    if win32service is not None:
+        results = scm_stop(names, cfg.get('service_timeout', SERVICE_TIMEOUT))
+    else:
+        results = net_stop(names)
 
-        combined = out + err
-        if '3521' in combined:
+    failed = False
+    for name, (status, reason) in zip(names, results):
+        if status == 'done':
+            f_log('DONE', 'SERVICE', f'Stopped "{name}"')
+        elif status == 'idle':
             f_log('DONE', 'SERVICE', f'"{name}" was not running')
-            continue
+        else:
+            f_log('ERRO', 'SERVICE', f'Failed stopping "{name}": {reason}')
+            failed = True
 
-        reason = err or out or f'Return code {code}'
-        f_log('ERRO', 'SERVICE', f'Failed stopping "{name}": {reason}')
+    if failed:
         sys.exit(1)
 
 def start_services(cfg):
-    for svc in cfg['services']:
-        name = svc['name']
+    # services that are already running come back as 'idle'
+    names = cfg['_service_names']
+    for name in names:
         f_log('INFO', 'SERVICE', f'Starting "{name}"...')
 
-        ok, out, err, code = run_cmd(f'net start "{name}"')
-        if ok:
-            f_log('DONE', 'SERVICE', f'Started "{name}"')
-            continue
+    if win32service is not None:
+        results = scm_start(names, cfg.get('service_timeout', SERVICE_TIMEOUT))
+    else:
+        results = net_start(names)
 
-        combined = out + err
-        if '2182' in combined:
+    for name, (status, reason) in zip(names, results):
+        if status == 'done':
+            f_log('DONE', 'SERVICE', f'Started "{name}"')
+        elif status == 'idle':
             f_log('DONE', 'SERVICE', f'"{name}" was already running')
-            continue
-
-        reason = err or out or f'Return code {code}'
-        f_log('WARN', 'SERVICE', f'Failed starting "{name}": {reason}')
+        else:
+            f_log('WARN', 'SERVICE', f'Failed starting "{name}": {reason}')
 
 # ---------------------------------------------
 # Docker compose operations
 # ---------------------------------------------
 def stop_docker(cfg):
-    docker_root = Path(cfg['docker_root'])
-
-    for name in cfg['docker_compose_names']:
-        compose = docker_root / name / 'docker-compose.yml'
+    projects = []
+    for name, compose, exists, argv in cfg['_compose_projects']:
         f_log('INFO', 'DOCKER', f'Stopping compose "{name}" -> "{compose}"...')
 
-        if not compose.exists():
+        if not exists:
             f_log('ERRO', 'DOCKER', f'Compose file not found')
             sys.exit(1)
 
-        ok, out, err, code = run_cmd(f'docker compose -f "{compose}" stop')
+        projects.append((name, argv + ['stop']))
+
+    failed = False
+    results = run_cmds([argv for name, argv in projects])
+    for (name, argv), (ok, out, err, code) in zip(projects, results):
         if ok:
             f_log('DONE', 'DOCKER', f'Stopped "{name}"')
         else:
             reason = err or out or f'Return code {code}'
             f_log('ERRO', 'DOCKER', f'Failed stopping "{name}": {reason}')
-            sys.exit(1)
+            failed = True
 
-def start_docker(cfg):
-    docker_root = Path(cfg['docker_root'])
+    if failed:
+        sys.exit(1)
 
-    for name in cfg['docker_compose_names']:
-        compose = docker_root / name / 'docker-compose.yml'
+def start_docker(cfg):
+    projects = []
+    for name, compose, exists, argv in cfg['_compose_projects']:
         f_log('INFO', 'DOCKER', f'Starting compose "{name}" -> "{compose}"...')
 
-        if not compose.exists():
+        if not exists:
             f_log('WARN', 'DOCKER', f'Compose file missing')
             continue
 
-        ok, out, err, code = run_cmd(f'docker compose -f "{compose}" start')
+        projects.append((name, argv + ['start']))
+
+    results = run_cmds([argv for name, argv in projects])
+    for (name, argv), (ok, out, err, code) in zip(projects, results):
         if ok:
             f_log('DONE', 'DOCKER', f'Started "{name}"')
         else:
@@ -177,63 +426,447 @@ def start_docker(cfg):
 # ---------------------------------------------
 # ZIP helper
 # ---------------------------------------------
-def zip_folder(src: Path, dst_zip: Path):
-    f_log('INFO', 'BACKUP', f'Compressing "{src}"...')
+def glob_regex(pat):
+    # '*' and '?' stay within one path segment, '**' spans segments
+    out = []
+    i = 0
+    while i < len(pat):
+        if pat.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        if pat.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
 
-    with zipfile.ZipFile(dst_zip, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
-        if src.is_file():
-            zf.write(src, arcname=src.name)
+        c = pat[i]
+        j = pat.find(']', i + 2)
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[' and j != -1:
+            body = pat[i + 1:j]
+            if body[0] in '!^':
+                body = '^/' + body[1:]
+            out.append('[' + body.replace('\\', '\\\\') + ']')
+            i = j
         else:
-            for p in src.rglob('*'):
-                if p.is_file():
-                    zf.write(p, arcname=str(p.relative_to(src)))
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+def compile_excludes(patterns):
+    # gitignore rules, matched against '/'-separated paths relative to the
+    # archived folder (directories are tested with a trailing '/'):
+    #   "node_modules", "*.tmp"  no slash: that name at any depth
+    #   "Logs/"                  trailing slash: directories only
+    #   "/build", "cache/*.log"  other slash: relative to the folder root
+    #   "**/tmp/**"              '**' crosses folders, '*' and '?' do not
+    # '!' negation is not supported
+    if not patterns:
+        return None
+
+    parts = []
+    for p in patterns:
+        p = p.replace('\\', '/')
+        dir_only = p.endswith('/')
+        p = p.rstrip('/')
+        rx = glob_regex(p.lstrip('/'))
+        if '/' not in p:
+            rx = '(?:.*/)?' + rx
+        parts.append(rx + ('/' if dir_only else '/?'))
+
+    flags = re.IGNORECASE if os.name == 'nt' else 0
+    return re.compile('|'.join(f'(?:{rx})' for rx in parts), flags)
+
+def is_excluded(spec, rel):
+    return spec.fullmatch(rel) is not None
+
+def iter_files(root, exclude=None):
+    # Iterative scandir walk: DirEntry type checks reuse the data
+    # returned by the directory listing instead of a stat per entry
+    cut = len(os.path.join(root, ''))
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                rel = entry.path[cut:].replace(os.sep, '/') if exclude else None
+                if entry.is_dir(follow_symlinks=False):
+                    if not (exclude and is_excluded(exclude, rel + '/')):
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    if not (exclude and is_excluded(exclude, rel)):
+                        yield entry
+
+def read_ahead(files, q, stop):
+    # Producer: a ZipInfo per file followed by its IO_CHUNK-sized pieces,
+    # then None; an exception is handed over to the consumer instead
+    try:
+        for path, arcname, _ in files:
+            q.put(zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False))
+            with open(path, 'rb', buffering=0) as f:
+                while chunk := f.read(IO_CHUNK):
+                    if stop.is_set():
+                        return
+                    q.put(chunk)
+        q.put(None)
+    except Exception as e:
+        q.put(e)
 
-    f_log('DONE', 'BACKUP', f'Created "{dst_zip}"')
+def write_entries(zf, files):
+    # Reads run on a separate thread so disk I/O overlaps the CRC and
+    # archive writes here (file reads and zlib both release the GIL)
+    q = queue.Queue(maxsize=8)
+    stop = threading.Event()
+    reader = threading.Thread(target=read_ahead, args=(files, q, stop), daemon=True)
+    reader.start()
+
+    dst = None
+    try:
+        while (item := q.get()) is not None:
+            if isinstance(item, zipfile.ZipInfo):
+                if dst:
+                    dst.close()
+                item.compress_type = zf.compression
+                item._compresslevel = zf.compresslevel
+                dst = zf.open(item, 'w')
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                dst.write(item)
+    finally:
+        if dst:
+            dst.close()
+        # unblock a reader stuck on a full queue so it can see the stop flag
+        stop.set()
+        while reader.is_alive():
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                reader.join(0.01)
+
+def preallocate(f, size):
+    # Reserve the archive's space in one go rather than growing it write
+    # by write; purely an optimisation, so failures are ignored
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)  # SetEndOfFile on Windows
+    except OSError:
+        pass
+
+# Runs in a worker process: no logging here, errors are raised to the caller
+def zip_folder(src: Path, dst_zip: Path, buffer_size=ZIP_BUFFER_SIZE, compression=zipfile.ZIP_STORED,
+               compresslevel=DEFLATE_LEVEL, exclude=()):
+    if src.is_file():
+        files = [(src, src.name, src.stat().st_size)]
+    else:
+        # plain strings in the loop; entry paths all start with src + separator
+        src_str = os.fspath(src)
+        cut = len(os.path.join(src_str, ''))
+        files = [(e.path, e.path[cut:], e.stat(follow_symlinks=False).st_size)
+                 for e in iter_files(src_str, compile_excludes(exclude))]
+
+    # upper bound: data + local header + central directory entry per file
+    total = sum(size + 8 * len(arcname) + 128 for _, arcname, size in files) + 128
+
+    # coalesce the many small header/data writes into large blocks
+    with open(dst_zip, 'wb', buffering=buffer_size) as f:
+        preallocate(f, total)
+        with zipfile.ZipFile(f, 'w', compression=compression, compresslevel=compresslevel,
+                             allowZip64=True, strict_timestamps=False) as zf:
+            try:
+                write_entries(zf, files)
+            except BaseException:
+                # a zf.open() that raised still leaves zipfile's writing flag
+                # set, and closing would then fail over this error; the
+                # partial archive is discarded by the caller anyway
+                zf._writing = False
+                raise
+        f.truncate()  # drop the unused tail of the reservation
+
+# ---------------------------------------------
+# tar + zstd helper
+# ---------------------------------------------
+def member_names(src: Path, exclude=()):
+    # Files of src relative to it, picked by the same walk and exclude
+    # rules as zip_folder; external archivers get this list instead of
+    # their own, differently behaving, exclude options
+    src_str = os.fspath(src)
+    cut = len(os.path.join(src_str, ''))
+    return [e.path[cut:] for e in iter_files(src_str, compile_excludes(exclude))]
+
+# Runs in a worker process like zip_folder. tar and zstd do the per-file
+# work natively, so Python only waits for the process.
+def tar_folder(src: Path, dst: Path, exclude=()):
+    # tar --zstd leaves zstd at its default of one thread; -T0 uses all cores
+    argv = ['tar', '-I', 'zstd -T0', '-cf', str(dst)]
+    if src.is_file():
+        ok, out, err, code = run_cmd(argv + ['-C', str(src.parent), src.name])
+    else:
+        # a folder's contents at the archive root, like zip_folder; the
+        # './' keeps names that start with '-' from reading as options
+        lst = dst.with_name(dst.name + '.lst')
+        try:
+            lst.write_bytes(b''.join(os.fsencode('./' + name) + b'\0' for name in member_names(src, exclude)))
+            ok, out, err, code = run_cmd(argv + ['-C', str(src), '--null', '-T', str(lst)])
+        finally:
+            lst.unlink(missing_ok=True)
+
+    if not ok:
+        raise RuntimeError(err or out or f'Return code {code}')
+
+def sevenzip_folder(src: Path, dst: Path, level=0, exclude=()):
+    # Same zip layout as zip_folder, but 7-Zip reads and deflates on all cores
+    argv = ['7z', 'a', '-tzip', '-mmt=on', f'-mx={level}', '-y', os.path.abspath(dst)]
+    if src.is_file():
+        ok, out, err, code = run_cmd(argv + [str(src)])
+    else:
+        names = member_names(src, exclude)
+        if not names:
+            zipfile.ZipFile(dst, 'w').close()  # 7-Zip has nothing to add
+            return
+
+        # names relative to src, read literally (-spd) from a UTF-8 list
+        lst = dst.with_name(dst.name + '.lst')
+        try:
+            lst.write_text('\n'.join(names) + '\n', encoding='utf-8')
+            ok, out, err, code = run_cmd(argv + ['-scsUTF-8', '-spd', f'@{os.path.abspath(lst)}'], cwd=src)
+        finally:
+            lst.unlink(missing_ok=True)
+
+    if not ok:
+        raise RuntimeError(err or out or f'Return code {code}')
 
 # ---------------------------------------------
 # Backup paths
 # ---------------------------------------------
+def existing_paths(paths):
+    # Sources sharing a parent are answered by one listing of that parent
+    # instead of a stat each; lone sources keep the plain exists() check
+    by_parent = {}
+    for p in paths:
+        by_parent.setdefault(p.parent, []).append(p)
+
+    found = set()
+    for parent, group in by_parent.items():
+        if len(group) == 1 or parent == group[0]:
+            found.update(p for p in group if p.exists())
+            continue
+
+        try:
+            with os.scandir(parent) as it:
+                names = {os.path.normcase(e.name) for e in it}
+        except OSError:
+            continue
+        found.update(p for p in group if os.path.normcase(p.name) in names)
+
+    return found
+
+def source_size(src: Path, exclude=None):
+    # Only a scheduling hint, so unreadable sources just count as empty
+    try:
+        if src.is_file():
+            return src.stat().st_size
+        return sum(e.stat(follow_symlinks=False).st_size for e in iter_files(os.fspath(src), exclude))
+    except OSError:
+        return 0
+
+def mirror_dir(ts_str, src):
+    # Folder inside the version that mirrors src's parent, e.g.
+    # C:\Data\app -> <ts>\C\Data; plain strings, no Path arithmetic
+    drive, rest = os.path.splitdrive(src)
+    return os.path.join(ts_str, drive.replace(':', ''), os.path.dirname(rest.lstrip('\\/')))
+
+def tree_signature(src: Path, exclude=None, salt=''):
+    # Digest of every file's relative path, size and mtime; equal digests
+    # mean the tree would produce the same archive again
+    h = hashlib.sha256(salt.encode())
+    if src.is_file():
+        st = src.stat()
+        h.update(f'{src.name}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode())
+        return h.hexdigest()
+
+    src_str = os.fspath(src)
+    cut = len(os.path.join(src_str, ''))
+    for e in iter_files(src_str, exclude):
+        st = e.stat(follow_symlinks=False)
+        h.update(f'{e.path[cut:]}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+# Runs in a worker process: hard links the previous archive when the tree
+# is unchanged, otherwise builds it; returns (signature, linked)
+def build_incremental(prev, salt, exclude, build, src, dst, *args):
+    sig = tree_signature(src, compile_excludes(exclude), salt)
+    if prev and prev['signature'] == sig:
+        try:
+            os.link(prev['archive'], dst)
+            return sig, True
+        except OSError:
+            pass  # gone, or another volume; fall back to a full build
+
+    build(src, dst, *args)
+    return sig, False
+
+def load_manifest(path: Path):
+    try:
+        return json_loads(path.read_bytes())
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(path: Path, manifest):
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(json.dumps(manifest, indent=2, ensure_ascii=False), encoding='utf-8')
+    os.replace(tmp, path)
+
 def backup_all_paths(cfg, timestamp):
+    global BACKUP_FAILED
     backup_root = Path(cfg['backup_root'])
     ts_folder = backup_root / timestamp
+    buffer_size = cfg.get('zip_buffer_size', ZIP_BUFFER_SIZE)
+    jobs = []
+
+    method = cfg.get('compression', 'stored')
+    if method not in COMPRESSION:
+        f_log('WARN', 'BACKUP', f'Unknown compression "{method}", using "stored"')
+        method = 'stored'
+    compression = COMPRESSION[method]
+    exclude = cfg.get('exclude', [])
+
+    archive_format = cfg.get('archive_format', 'zip')
+    if archive_format not in ARCHIVE_EXT:
+        f_log('WARN', 'BACKUP', f'Unknown archive format "{archive_format}", using "zip"')
+        archive_format = 'zip'
+    ext = ARCHIVE_EXT[archive_format]
+
+    # ISA-L, when it backs zipfile, only knows levels 0-3; 7-Zip goes to 9
+    top = isal_zlib.ISAL_BEST_COMPRESSION if isal_zlib is not None and archive_format == 'zip' else 9
+    compresslevel = cfg.get('compress_level', DEFLATE_LEVEL)
+    if type(compresslevel) is not int or not 0 <= compresslevel <= top:
+        f_log('WARN', 'BACKUP', f'Invalid compress level "{compresslevel}" (0-{top}), using {DEFLATE_LEVEL}')
+        compresslevel = DEFLATE_LEVEL
+
+    # destination folders already created during this run
+    made_dirs = set()
+    ts_str = os.fspath(ts_folder)
+
+    docker_root = Path(cfg['docker_root'])
+    present = existing_paths([Path(src) for svc in cfg['services'] for src in svc['paths']] +
+                             [docker_root / name for name in cfg['docker_compose_names']])
 
     # Services
     for svc in cfg['services']:
         for src in svc['paths']:
             src_path = Path(src)
-            if not src_path.exists():
+            if src_path not in present:
                 f_log('WARN', 'BACKUP', f'Skipped missing path: "{src_path}"')
                 continue
 
-            drive = src_path.drive.replace(':', '')
-            rel = src_path.relative_to(src_path.anchor)  # full path after drive
-
-            dst_dir = ts_folder / drive / rel.parent
-            dst_dir.mkdir(parents=True, exist_ok=True)
+            dst_dir = mirror_dir(ts_str, os.fspath(src_path))
+            if dst_dir not in made_dirs:
+                os.makedirs(dst_dir, exist_ok=True)
+                made_dirs.add(dst_dir)
 
-            dst_zip = dst_dir / (src_path.name + '.zip')
-            zip_folder(src_path, dst_zip)
+            jobs.append((src_path, Path(dst_dir, src_path.name + ext)))
 
     # Docker
-    docker_root = Path(cfg['docker_root'])
     for name in cfg['docker_compose_names']:
         src = docker_root / name
-        if not src.exists():
+        if src not in present:
             f_log('WARN', 'BACKUP', f'Skipped missing path: "{src}"')
             continue
 
-        drive = src.drive.replace(':', '')
-        rel = src.relative_to(src.anchor)
+        dst_dir = mirror_dir(ts_str, os.fspath(src))
+        if dst_dir not in made_dirs:
+            os.makedirs(dst_dir, exist_ok=True)
+            made_dirs.add(dst_dir)
+
+        jobs.append((src, Path(dst_dir, name + ext)))
+
+    if not jobs:
+        return
+
+    # Archives are independent, build them concurrently
+    workers = cfg.get('zip_workers', max(1, (os.cpu_count() or 2) // 2))
 
-        dst_dir = ts_folder / drive / rel.parent
-        dst_dir.mkdir(parents=True, exist_ok=True)
+    # With more jobs than workers, start the biggest first so one large
+    # tree doesn't begin last and stretch the whole phase
+    if len(jobs) > workers:
+        spec = compile_excludes(exclude)
+        jobs.sort(key=lambda job: source_size(job[0], spec), reverse=True)
 
-        dst_zip = dst_dir / (name + '.zip')
-        zip_folder(src, dst_zip)
+    if archive_format == 'zst':
+        build, args = tar_folder, (exclude,)
+    elif archive_format == '7z':
+        build, args = sevenzip_folder, (compresslevel if compression == zipfile.ZIP_DEFLATED else 0, exclude)
+    else:
+        build, args = zip_folder, (buffer_size, compression, compresslevel, exclude)
+
+    # Incremental: sources whose files (path, size, mtime) match the last
+    # run are hard linked to the previous archive instead of rebuilt
+    incremental = cfg.get('incremental', False)
+    if incremental:
+        manifest_path = backup_root / 'manifest.json'
+        manifest = load_manifest(manifest_path)
+        salt = repr((archive_format, method, compresslevel, exclude))
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as ex:
+        futures = {}
+        for src, dst in jobs:
+            f_log('INFO', 'BACKUP', f'Compressing "{src}"...')
+            if incremental:
+                fut = ex.submit(build_incremental, manifest.get(str(src)), salt, exclude, build, src, dst, *args)
+            else:
+                fut = ex.submit(build, src, dst, *args)
+            futures[fut] = (src, dst)
+
+        for fut in as_completed(futures):
+            src, dst = futures[fut]
+            try:
+                result = fut.result()
+            except Exception as e:
+                f_log('ERRO', 'BACKUP', f'Failed compressing "{src}": {e}')
+                BACKUP_FAILED = True
+                # a partial archive keeps its preallocated size and would pass for a backup
+                try:
+                    dst.unlink(missing_ok=True)
+                except OSError as e:
+                    f_log('WARN', 'BACKUP', f'Failed removing partial "{dst}": {e}')
+                if incremental:
+                    manifest.pop(str(src), None)
+                continue
+
+            if incremental:
+                sig, linked = result
+                manifest[str(src)] = {'signature': sig, 'archive': str(dst)}
+                if linked:
+                    f_log('DONE', 'BACKUP', f'Unchanged, linked "{dst}"')
+                    continue
+            f_log('DONE', 'BACKUP', f'Created "{dst}"')
+
+    if incremental:
+        try:
+            save_manifest(manifest_path, manifest)
+        except OSError as e:
+            f_log('WARN', 'BACKUP', f'Failed writing manifest: {e}')
 
 # ---------------------------------------------
 # Retention pruning
 # ---------------------------------------------
+def parse_version(name):
+    # Same result as strptime(name, '%Y-%m-%d %H%M%S') without interpreting
+    # the format string for every entry; None when name is not a version
+    m = VERSION_RE.fullmatch(name)
+    if not m:
+        return None
+    try:
+        return datetime(*map(int, m.groups()))
+    except ValueError:  # well-formed but not a real date, e.g. month 13
+        return None
+
 def prune_versions(cfg):
     root = Path(cfg['backup_root'])
     days = cfg['retention_days']
@@ -242,52 +875,61 @@ def prune_versions(cfg):
 
     # timestamp directories only
     versions = []
-    for d in root.iterdir():
-        if not d.is_dir():
-            continue
-        try:
-            t = datetime.strptime(d.name, '%Y-%m-%d %H%M%S')
-            versions.append((d, t))
-        except:
-            continue
-
-    if not versions:
-        return
+    trash = []
+    # match the name first; is_dir comes from the scandir entry, no extra stat
+    with os.scandir(root) as it:
+        for e in it:
+            if e.name.startswith('.trash_'):
+                if e.is_dir(follow_symlinks=False):
+                    d = Path(e.path)
+                    trash.append((d, d))  # left over from an interrupted prune
+                continue
+            t = parse_version(e.name)
+            if t is None:
+                continue
+            if e.is_dir(follow_symlinks=False):
+                versions.append((Path(e.path), t))
 
-    versions.sort(key=lambda x: x[1])  # oldest first
     now = datetime.now()
 
-    to_delete = []
-
     # delete by days
-    for d, t in versions:
-        if (now - t).days > days:
-            to_delete.append((d, t))
+    to_delete = [(d, t) for d, t in versions if (now - t).days > days]
 
-    # enforce min versions
-    remain = len(versions) - len(to_delete)
-    if remain < min_v:
-        need_keep = min_v - remain
-        to_delete = to_delete[:-need_keep] if need_keep < len(to_delete) else []
+    # enforce min versions: spare the newest of the expired ones
+    need_keep = min_v - (len(versions) - len(to_delete))
+    if need_keep > 0:
+        to_delete = heapq.nsmallest(len(to_delete) - need_keep, to_delete, key=lambda x: x[1])
 
-    # enforce max versions
+    # enforce max versions: only the oldest excess matter, no full sort
     if max_v > 0 and len(versions) > max_v:
-        excess = len(versions) - max_v
-        extra = versions[:excess]  # oldest
-        extra_dirs = {d for d, t in extra}
-        for d, t in versions:
-            if d in extra_dirs and (d, t) not in to_delete:
+        doomed = {d for d, t in to_delete}
+        for d, t in heapq.nsmallest(len(versions) - max_v, versions, key=lambda x: x[1]):
+            if d not in doomed:
                 to_delete.append((d, t))
 
-    # remove
+    to_delete.sort(key=lambda x: x[1])  # log oldest first
+
+    # move doomed versions aside (a cheap rename), then delete the trees in parallel
     for d, t in to_delete:
         f_log('INFO', 'PRUNE', f'Deleting old version "{t.strftime('%Y-%m-%d %H%M%S')}"...')
         try:
-            shutil.rmtree(d)
-            f_log('DONE', 'PRUNE', f'Deleted "{d}"')
+            trash.append((d, d.rename(d.with_name(f'.trash_{uuid.uuid4().hex}'))))
         except Exception as e:
             f_log('WARN', 'PRUNE', f'Failed deleting "{d}": {e}')
 
+    if not trash:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(4, len(trash))) as ex:
+        futures = {ex.submit(shutil.rmtree, tmp): d for d, tmp in trash}
+        for fut in as_completed(futures):
+            d = futures[fut]
+            try:
+                fut.result()
+                f_log('DONE', 'PRUNE', f'Deleted "{d}"')
+            except Exception as e:
+                f_log('WARN', 'PRUNE', f'Failed deleting "{d}": {e}')
+
 # ---------------------------------------------
 # Full backup process
 # ---------------------------------------------
@@ -300,22 +942,73 @@ def do_backup(cfg):
     # Open log file
     global LOG_FILE_HANDLE, CURRENT_LOG_PATH
     CURRENT_LOG_PATH = ts_folder / 'log.txt'
-    LOG_FILE_HANDLE = open(CURRENT_LOG_PATH, 'w', encoding='utf-8')
+    LOG_FILE_HANDLE = open(CURRENT_LOG_PATH, 'w', encoding='utf-8', buffering=1 << 16)
 
     # Save config snapshot
     f_log('INFO', 'CONFIG', 'Copying config...')
     try:
-        shutil.copy2(CONFIG_FILE, ts_folder / 'config.json')
+        (ts_folder / 'config.json').write_bytes(CONFIG_BYTES)
         f_log('INFO', 'CONFIG', f'Created "{ts_folder / 'config.json'}"')
     except Exception as e:
         f_log('WARN', 'CONFIG', f'Failed creating config: {e}')
 
     backup_all_paths(cfg, ts)
 
+# ---------------------------------------------
+# Phases
+# ---------------------------------------------
+def run_together(cfg, steps):
+    # Services and docker touch disjoint resources, so their stop (or
+    # start) phases overlap. A sys.exit inside a step is re-raised here
+    # once every step has finished.
+    if len(steps) <= 1:
+        for step in steps:
+            step(cfg)
+        return
+
+    with ThreadPoolExecutor(max_workers=len(steps)) as ex:
+        futures = [ex.submit(step, cfg) for step in steps]
+
+    failed = [fut for fut in futures if fut.exception() is not None]
+    if not failed:
+        return
+
+    # The run is aborting, so nothing else will start again what the
+    # successful stops took down; do it before re-raising
+    for step, fut in zip(steps, futures):
+        if fut.exception() is None and step in UNDO:
+            f_log('WARN', 'MAIN', f'Stop stage failed, running {UNDO[step].__name__} to undo {step.__name__}')
+            UNDO[step](cfg)
+    failed[0].result()
+
+# a stop step and the start step that reverses it
+UNDO = {stop_services: start_services, stop_docker: start_docker}
+
 # ---------------------------------------------
 # Main
 # ---------------------------------------------
+# Stages run in order; the steps of one stage run together
+STAGES = [(stop_services, stop_docker), (do_backup,), (start_services, start_docker), (prune_versions,)]
+
+ACTIONS = {
+    'backup': {stop_services, stop_docker, do_backup, start_services, start_docker, prune_versions},
+    'help': set(),
+    'prune': {prune_versions},
+    'start': {start_services, start_docker},
+    'startDocker': {start_docker},
+    'startServices': {start_services},
+    'stop': {stop_services, stop_docker},
+    'stopDocker': {stop_docker},
+    'stopServices': {stop_services},
+    'restart': {stop_services, stop_docker, start_services, start_docker},
+    'restartDocker': {stop_docker, start_docker},
+    'restartServices': {stop_services, start_services},
+}
+
 def main():
+    # log.txt is block-buffered; flush it on any exit, Ctrl-C included
+    atexit.register(flush_log)
+
     log('''Windows Service Backup
 The MIT License (MIT)
 Copyright (c) 2025 Jonathan Chiu
@@ -326,32 +1019,30 @@ Copyright (c) 2025 Jonathan Chiu
         sys.exit(1)
 
     mode = sys.argv[1]
-    if sys.argv[1] not in COMMANDS:
+    if sys.argv[1] not in ACTIONS:
         f_log('ERRO', 'MAIN', f'Unknown command "{sys.argv[1]}". Run "python main.py help" for usage.')
         sys.exit(1)
 
     cfg = {}
+    actions = ACTIONS[mode]
 
     if mode == 'help':
         log(USAGE)
     else:
-        cfg = load_config()
+        cfg = load_config(actions)
 
-    if mode == 'backup' or mode == 'restart' or mode == 'restartServices' or mode == 'stop' or mode == 'stopServices':
-        stop_services(cfg)
-    if mode == 'backup' or mode == 'restart' or mode == 'restartServices' or mode == 'stop' or mode == 'stopDocker':
-        stop_docker(cfg)
+    for stage in STAGES:
+        steps = [step for step in stage if step in actions]
+        # an incomplete version must not count toward retention and push
+        # out the last good ones
+        if BACKUP_FAILED and prune_versions in steps:
+            f_log('WARN', 'PRUNE', 'Skipped pruning, this backup is incomplete')
+            steps.remove(prune_versions)
+        run_together(cfg, steps)
 
-    if mode == 'backup':
-        do_backup(cfg)
-
-    if mode == 'backup' or mode == 'restart' or mode == 'restartServices' or mode == 'start' or mode == 'startServices':
-        start_services(cfg)
-    if mode == 'backup' or mode == 'restart' or mode == 'restartDocker' or mode == 'start' or mode == 'startServices':
-        start_docker(cfg)
-
-    if mode == 'backup' or mode == 'prune':
-        prune_versions(cfg)
+    # services are back and pruning was skipped; now let the scheduler see the failure
+    if BACKUP_FAILED:
+        f_log('ERRO', 'MAIN', 'Backup incomplete, one or more archives failed')
 
     log('''
 Run complete.''')
@@ -361,5 +1052,8 @@ Run complete.''')
         LOG_FILE_HANDLE.close()
         LOG_FILE_HANDLE = None
 
+    if BACKUP_FAILED:
+        sys.exit(1)
+
 if __name__ == '__main__':
     main()